@@ -1,31 +1,129 @@
+from contextlib import asynccontextmanager
+
+import anyio
+import orjson
+from cachetools import TTLCache
 from fastapi import FastAPI, Depends, HTTPException, Query
-from fastapi.responses import RedirectResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse, RedirectResponse, Response, StreamingResponse
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import func, desc
-from typing import List, Optional
+from sqlalchemy import func, select, text
+from typing import Dict, List, Literal, Optional
 
 from database import SessionLocal, engine
-from models import YahooData, Base
-from schemas import YahooDataSchema
+from models import YahooData, Base, ensure_schema
+from schemas import YahooDataSchema, YahooDataPage
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create database tables and any indexes missing from an existing table
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(ensure_schema)
+    yield
+    await engine.dispose()
+
 
 app = FastAPI(
     title="Undervalued Stock's API",
     description="API for retrieving Yahoo Finance stock data and price targets",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Validates and serializes a whole result page in one pass
+_ADAPTER = TypeAdapter(List[YahooDataSchema])
+# Rows fetched per server-side cursor round trip when streaming /data/
+STREAM_CHUNK_SIZE = 50
+
+# Statistics only change when main.py reloads the table, so serve them from a short-lived cache
+_STATS_CACHE = TTLCache(maxsize=1, ttl=60)
+# Serialized /undervalued/ responses keyed by query parameters
+_UNDERVALUED_CACHE = TTLCache(maxsize=512, ttl=60)
+# Index backing each /undervalued/ sort option, hinted to pg_hint_plan when it is installed
+SortField = Literal["difference_low", "difference_median", "difference_high", "volume_numeric", "last_price"]
+SORT_INDEX: Dict[SortField, str] = {
+    "difference_low": "ix_yd_undervalued",
+    "difference_median": "ix_yd_diff_median",
+    "difference_high": "ix_yd_diff_high",
+    "volume_numeric": "ix_yd_volume",
+    "last_price": "ix_yd_last_price",
+}
+
+
+def _undervalued_stmt(sort_by, ascending):
+    """Build the base /undervalued/ statement for one sort option."""
+    sort_column = getattr(YahooData, sort_by)
+    return (
+        select(YahooData)
+        .prefix_with(f"/*+ IndexScan(yahoo_data {SORT_INDEX[sort_by]}) */", dialect="postgresql")
+        .where(YahooData.difference_low.isnot(None))
+        .order_by(sort_column.asc() if ascending else sort_column.desc())
+    )
+
+
+# Built once so each sort option reuses the same statement and its compiled SQL cache entry
+UNDERVALUED_STMTS = {
+    (sort_by, ascending): _undervalued_stmt(sort_by, ascending)
+    for sort_by in SORT_INDEX
+    for ascending in (False, True)
+}
 
 
 # Dependency to get the database session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+def _serialize(rows):
+    """Convert ORM rows into JSON-ready dicts."""
+    return _ADAPTER.dump_python(_ADAPTER.validate_python(rows, from_attributes=True), mode="json")
+
+
+async def _close_session(db):
+    """Close a session even when the surrounding task is being cancelled."""
+    with anyio.CancelScope(shield=True):
+        await db.close()
+
+
+class SessionStreamingResponse(StreamingResponse):
+    """StreamingResponse that closes its session once the response is done.
+
+    The close runs even if the client disconnects before the body is iterated,
+    so it does not depend on finalizing the body generator.
+    """
+
+    def __init__(self, content, db, **kwargs):
+        super().__init__(content, **kwargs)
+        self.db = db
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await _close_session(self.db)
+
+
+async def _stream_page(partitions, first_chunk, next_cursor):
+    """Write a YahooDataPage as JSON one partition of rows at a time.
+
+    The first partition is serialized before the response starts, so its errors
+    still become a 500. A later failure can no longer change the status code;
+    the page is then closed with a null next_cursor and an "error" message.
+    """
+    yield b'{"items":[' + first_chunk
+    try:
+        async for rows in partitions:
+            yield b"," + orjson.dumps(_serialize(rows))[1:-1]
+            next_cursor = rows[-1].symbol
+    except (SQLAlchemyError, ValidationError) as e:
+        yield b'],"next_cursor":null,"error":' + orjson.dumps(str(e)) + b"}"
+        return
+    yield b'],"next_cursor":' + orjson.dumps(next_cursor) + b"}"
 
 # Add a root endpoint that redirects to /data/
 @app.get("/")
@@ -33,30 +131,49 @@ async def root():
     """Redirect to the data endpoint."""
     return RedirectResponse(url="/data/")
 
-@app.get("/data/", response_model=List[YahooDataSchema], tags=["Data"])
+@app.get("/data/", response_model=YahooDataPage, tags=["Data"])
 async def read_data(
-        skip: int = Query(0, description="Number of records to skip"),
+        after_symbol: Optional[str] = Query(None, description="Return records after this symbol (cursor)"),
         limit: int = Query(100, description="Number of records to return"),
-        min_volume: Optional[int] = Query(None, description="Filter by minimum volume"),
-        db: Session = Depends(get_db)
+        min_volume: Optional[int] = Query(None, description="Filter by minimum volume")
 ):
-    """Retrieve stock data with optional filtering and pagination."""
+    """Retrieve stock data with optional filtering and keyset pagination on symbol.
+
+    Rows are streamed from a server-side cursor, so the session is owned by the
+    response rather than the get_db dependency.
+    """
+    db = SessionLocal()
     try:
-        query = db.query(YahooData)
+        stmt = select(YahooData).order_by(YahooData.symbol)
+
+        if after_symbol is not None:
+            stmt = stmt.where(YahooData.symbol > after_symbol.upper())
 
         if min_volume is not None:
-            query = query.filter(YahooData.volume_numeric >= min_volume)
+            stmt = stmt.where(YahooData.volume_numeric >= min_volume)
 
-        return query.offset(skip).limit(limit).all()
-    except SQLAlchemyError as e:
+        result = await db.stream(stmt.limit(limit).execution_options(yield_per=STREAM_CHUNK_SIZE))
+        partitions = result.scalars().partitions()
+        first_rows = await anext(partitions, None)
+        if first_rows is None:
+            await _close_session(db)
+            return ORJSONResponse({"items": [], "next_cursor": None})
+        first_chunk = orjson.dumps(_serialize(first_rows))[1:-1]
+    except (SQLAlchemyError, ValidationError) as e:
+        await _close_session(db)
         raise HTTPException(status_code=500, detail=str(e))
+    return SessionStreamingResponse(
+        _stream_page(partitions, first_chunk, first_rows[-1].symbol),
+        db,
+        media_type="application/json"
+    )
 
 
 @app.get("/data/{symbol}", response_model=YahooDataSchema, tags=["Data"])
-async def read_stock_data(symbol: str, db: Session = Depends(get_db)):
+async def read_stock_data(symbol: str, db: AsyncSession = Depends(get_db)):
     """Retrieve stock data for a specific symbol."""
     try:
-        stock = db.query(YahooData).filter(YahooData.symbol == symbol.upper()).first()
+        stock = await db.get(YahooData, symbol.upper())
         if stock is None:
             raise HTTPException(status_code=404, detail=f"Stock {symbol} not found")
         return stock
@@ -65,15 +182,31 @@ async def read_stock_data(symbol: str, db: Session = Depends(get_db)):
 
 
 @app.get("/stats/", tags=["Statistics"])
-async def get_statistics(db: Session = Depends(get_db)):
-    """Get basic statistics about the stored data."""
+async def get_statistics(db: AsyncSession = Depends(get_db)):
+    """Get basic statistics about the stored data.
+
+    The stock count is the planner estimate maintained by VACUUM/ANALYZE, and
+    results are cached for 60 seconds.
+    """
+    if "stats" in _STATS_CACHE:
+        return _STATS_CACHE["stats"]
     try:
-        total_stocks = db.query(YahooData).count()
-        avg_volume = db.query(func.avg(YahooData.volume_numeric)).scalar()
-        return {
+        result = await db.execute(text(
+            "SELECT reltuples::bigint, (SELECT avg(volume_numeric) FROM yahoo_data) "
+            "FROM pg_class WHERE oid = 'yahoo_data'::regclass"
+        ))
+        total_stocks, avg_volume = result.one()
+
+        # reltuples is -1 until the table has been vacuumed or analyzed
+        if total_stocks < 0:
+            total_stocks = await db.scalar(select(func.count()).select_from(YahooData))
+
+        stats = {
             "total_stocks": total_stocks,
             "average_volume": int(avg_volume) if avg_volume else 0
         }
+        _STATS_CACHE["stats"] = stats
+        return stats
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -87,13 +220,9 @@ async def get_undervalued_stocks(
         min_target_diff: Optional[float] = Query(None, description="Minimum difference from low target in percent",
                                                  ge=0),
         exclude_above_median: bool = Query(False, description="Exclude stocks trading above median target"),
-        sort_by: str = Query(
-            "difference_low",
-            description="Sort criterion",
-            enum=["difference_low", "difference_median", "difference_high", "volume_numeric", "last_price"]
-        ),
+        sort_by: SortField = Query("difference_low", description="Sort criterion"),
         ascending: bool = Query(False, description="Sort in ascending order"),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
     """Get undervalued stocks with various filtering options.
 
@@ -107,32 +236,34 @@ async def get_undervalued_stocks(
     - sort_by: Field to sort results by
     - ascending: Sort in ascending order instead of descending
     """
+    cache_key = (limit, min_volume, min_price, max_price, min_target_diff, exclude_above_median, sort_by, ascending)
+    cached = _UNDERVALUED_CACHE.get(cache_key)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
     try:
-        # Start with base query
-        query = db.query(YahooData).filter(YahooData.difference_low.isnot(None))
+        # Start with the prebuilt sorted query, hinted onto the index for the sort column
+        stmt = UNDERVALUED_STMTS[sort_by, ascending]
 
         # Apply filters
         if min_volume is not None:
-            query = query.filter(YahooData.volume_numeric >= min_volume)
+            stmt = stmt.where(YahooData.volume_numeric >= min_volume)
 
         if min_price is not None:
-            query = query.filter(YahooData.last_price >= min_price)
+            stmt = stmt.where(YahooData.last_price >= min_price)
 
         if max_price is not None:
-            query = query.filter(YahooData.last_price <= max_price)
+            stmt = stmt.where(YahooData.last_price <= max_price)
 
         if min_target_diff is not None:
-            query = query.filter(YahooData.difference_low >= min_target_diff)
+            stmt = stmt.where(YahooData.difference_low >= min_target_diff)
 
         if exclude_above_median:
-            query = query.filter(YahooData.difference_median >= 0)
-
-        # Apply sorting
-        sort_column = getattr(YahooData, sort_by)
-        query = query.order_by(sort_column.asc() if ascending else sort_column.desc())
+            stmt = stmt.where(YahooData.difference_median >= 0)
 
         # Get results
-        stocks = query.limit(limit).all()
+        result = await db.execute(stmt.limit(limit))
+        stocks = result.scalars().all()
 
         if not stocks:
             raise HTTPException(
@@ -140,6 +271,8 @@ async def get_undervalued_stocks(
                 detail="No stocks found matching the specified criteria"
             )
 
-        return stocks
+        content = orjson.dumps(_serialize(stocks))
+        _UNDERVALUED_CACHE[cache_key] = content
+        return Response(content=content, media_type="application/json")
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=str(e))
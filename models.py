@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Float, Integer
+from sqlalchemy import Column, String, Float, Integer, Index, inspect
 from database import Base
 
 class YahooData(Base):
@@ -16,4 +16,33 @@ class YahooData(Base):
     volume_str = Column(String(10))
     market_cap = Column(Float)
     pb_ratio = Column(Float)
-    short_interest = Column(Float)
\ No newline at end of file
+    short_interest = Column(Float)
+
+    # Indexes backing the /undervalued/ filters and sort options
+    __table_args__ = (
+        # Partial covering index: /undervalued/ always filters out NULL low targets
+        Index('ix_yd_undervalued', difference_low.desc(), volume_numeric,
+              postgresql_where=difference_low.isnot(None),
+              postgresql_include=['symbol', 'last_price', 'volume_str']),
+        Index('ix_yd_volume', volume_numeric),
+        Index('ix_yd_last_price', last_price),
+        Index('ix_yd_diff_median', difference_median),
+        Index('ix_yd_diff_high', difference_high),
+    )
+
+
+def ensure_schema(connection, rebuild_legacy=False):
+    """Create yahoo_data if needed and add any of its indexes that are missing.
+
+    Tables written by pandas' to_sql(if_exists='replace') have no primary key.
+    With rebuild_legacy=True such a table is dropped and recreated from the model,
+    which is only safe when the caller reloads the data in the same transaction.
+    """
+    table = YahooData.__table__
+    inspector = inspect(connection)
+    if (rebuild_legacy and inspector.has_table(table.name)
+            and not inspector.get_pk_constraint(table.name)["constrained_columns"]):
+        table.drop(connection)
+    table.create(connection, checkfirst=True)
+    for index in table.indexes:
+        index.create(connection, checkfirst=True)
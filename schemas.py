@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 class YahooDataSchema(BaseModel):
     symbol: str
@@ -19,3 +19,10 @@ class YahooDataSchema(BaseModel):
 
     class Config:
         from_attributes = True
+
+
+class YahooDataPage(BaseModel):
+    items: List[YahooDataSchema]
+    next_cursor: Optional[str]
+    # Set when streaming fails after the first partition; items are then incomplete
+    error: Optional[str] = None